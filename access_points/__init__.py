@@ -287,6 +287,9 @@ def print_version():
 def main():
     if '-v' in sys.argv or 'version' in sys.argv:
         print_version()
+    elif sys.argv[1:2] == ['collect']:
+        from access_points.collect import main as collect_main
+        collect_main(sys.argv[2:])
     else:
         device = [x for x in sys.argv[1:] if "-" not in x] or [""]
         device = device[0]
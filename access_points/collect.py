@@ -0,0 +1,484 @@
+""" Collect scans from many sensors and flush them to columnar files.
+
+Sensors post the output of ``access_points`` (``json.dumps(access_points)``)
+over HTTP or UDP. To cut the per-request overhead a sensor can also send
+several scans at once as newline-delimited JSON objects:
+
+    {"sensor": "hall-1", "time": 1700000000.0, "access_points": [...]}
+
+Scans are buffered column by column, with the sensor, SSID, BSSID and
+security strings interned once per batch and column, and written out as
+Parquet when pyarrow is installed, or as gzipped JSON columns otherwise.
+A missing quality is written as null.
+"""
+
+import os
+import gzip
+import json
+import time
+import logging
+import argparse
+import threading
+from array import array
+
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qs
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from access_points import ensure_str
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+COLUMNS = ("time", "sensor", "ssid", "bssid", "quality", "security")
+STRING_COLUMNS = ("sensor", "ssid", "bssid", "security")
+EXTENSIONS = {"parquet": "parquet", "json": "json.gz"}
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+# parsers can leave quality unset, e.g. iwlist cells without a quality line;
+# buffered as a value no scanner reports and written out as null
+MISSING_QUALITY = INT32_MIN
+# largest HTTP body read into memory at once
+MAX_BODY = 64 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_text(value, field):
+    if value is None:
+        return ""
+    if not isinstance(value, basestring):
+        raise TypeError("{} should be a string, got {!r}".format(field, value))
+    return value
+
+
+class StringTable(object):
+    """Map strings to small integer ids, so each one is stored only once."""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, string):
+        try:
+            return self.ids[string]
+        except KeyError:
+            idx = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            return idx
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class ScanBatch(object):
+    """Access points of many scans, stored as one typed array per column."""
+
+    def __init__(self):
+        # one table per column, so each column's dictionary holds only its own values
+        self.strings = {name: StringTable() for name in STRING_COLUMNS}
+        self.time = array("d")
+        self.quality = array("i")
+        self.sensor = array("i")
+        self.ssid = array("i")
+        self.bssid = array("i")
+        self.security = array("i")
+        self.scans = 0
+
+    def __len__(self):
+        return len(self.time)
+
+    @staticmethod
+    def rows(sensor, access_points, timestamp):
+        """Validate one scan into (time, sensor, ssid, bssid, quality, security) rows.
+
+        Raises ValueError, TypeError or AttributeError on a malformed scan, so
+        a bad scan is rejected before anything is added to a batch.
+        """
+        sensor = ensure_text(sensor, "sensor")
+        timestamp = float(timestamp)
+        rows = []
+        for ap in access_points:
+            security = ap.get("security")
+            if isinstance(security, list):
+                # iwlist reports a list of IE lines
+                security = "; ".join(ensure_text(ie, "security") for ie in security)
+            quality = ap.get("quality")
+            if quality is None:
+                quality = MISSING_QUALITY
+            else:
+                quality = int(quality)
+                if not INT32_MIN < quality <= INT32_MAX:
+                    raise ValueError("quality out of range: {}".format(quality))
+            rows.append((timestamp, sensor, ensure_text(ap.get("ssid"), "ssid"),
+                         ensure_text(ap.get("bssid"), "bssid"), quality,
+                         ensure_text(security, "security")))
+        return rows
+
+    def add(self, rows, scans=1):
+        """Append rows from ``ScanBatch.rows``; these can no longer fail halfway."""
+        sensors = self.strings["sensor"].intern
+        ssids = self.strings["ssid"].intern
+        bssids = self.strings["bssid"].intern
+        securities = self.strings["security"].intern
+        for timestamp, sensor, ssid, bssid, quality, security in rows:
+            self.time.append(timestamp)
+            self.sensor.append(sensors(sensor))
+            self.ssid.append(ssids(ssid))
+            self.bssid.append(bssids(bssid))
+            self.quality.append(quality)
+            self.security.append(securities(security))
+        self.scans += scans
+
+    def merge(self, other):
+        """Append all rows of another batch, re-interning its strings."""
+        self.time.extend(other.time)
+        self.quality.extend(other.quality)
+        for name in STRING_COLUMNS:
+            intern = self.strings[name].intern
+            ids = [intern(string) for string in other.strings[name].strings]
+            getattr(self, name).extend(array("i", [ids[i] for i in getattr(other, name)]))
+        self.scans += other.scans
+
+
+def quality_list(batch):
+    return [None if quality == MISSING_QUALITY else quality for quality in batch.quality]
+
+
+def write_parquet(batch, path):
+    arrays = []
+    for name in COLUMNS:
+        column = getattr(batch, name)
+        if name in STRING_COLUMNS:
+            indices = pyarrow.array(column, pyarrow.int32())
+            strings = pyarrow.array(batch.strings[name].strings, pyarrow.string())
+            arrays.append(pyarrow.DictionaryArray.from_arrays(indices, strings))
+        elif name == "time":
+            arrays.append(pyarrow.array(column, pyarrow.float64()))
+        else:
+            arrays.append(pyarrow.array(quality_list(batch), pyarrow.int32()))
+    table = pyarrow.Table.from_arrays(arrays, names=list(COLUMNS))
+    pyarrow.parquet.write_table(table, path)
+
+
+def write_json(batch, path):
+    columns = {name: getattr(batch, name).tolist() for name in COLUMNS}
+    columns["quality"] = quality_list(batch)
+    strings = {name: table.strings for name, table in batch.strings.items()}
+    data = {"strings": strings, "columns": columns}
+    with gzip.open(path, "wb") as f:
+        f.write(json.dumps(data, separators=(",", ":")).encode("utf8"))
+
+
+def write_batch(batch, path, fmt):
+    """Write a batch atomically, so readers never see a partial file."""
+    tmp_path = path + ".tmp"
+    try:
+        if fmt == "parquet":
+            write_parquet(batch, tmp_path)
+        else:
+            write_json(batch, tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_batch(path):
+    """Read a flushed file back into a dict of plain column lists.
+
+    A missing quality is read back as None.
+    """
+    if path.endswith(".parquet"):
+        return pyarrow.parquet.read_table(path).to_pydict()
+    with gzip.open(path, "rb") as f:
+        data = json.loads(ensure_str(f.read()))
+    columns = data["columns"]
+    for name in STRING_COLUMNS:
+        strings = data["strings"][name]
+        columns[name] = [strings[i] for i in columns[name]]
+    return columns
+
+
+def parse_payload(payload, sensor=None):
+    """Turn a posted body into a list of (sensor, access_points, timestamp).
+
+    A body starting with ``[`` is a single scan as printed by ``access_points``,
+    anything else is read as newline-delimited scan objects.
+    """
+    payload = ensure_str(payload).strip()
+    if not payload:
+        return []
+    if payload.startswith("["):
+        return [(sensor, json.loads(payload), None)]
+    scans = []
+    for line in payload.split("\n"):
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        scans.append((data.get("sensor", sensor), data["access_points"], data.get("time")))
+    return scans
+
+
+class Collector(object):
+    """Buffer scans from many sensors and flush them in batches.
+
+    A batch is flushed once it holds ``batch_size`` access points, or every
+    ``flush_interval`` seconds once ``start()`` is called; after ``start()``
+    all writes happen on the flush thread rather than on the thread adding
+    scans. After a failed write, full batches wait ``flush_interval`` before
+    the next attempt. When more than ``max_pending`` access points are
+    waiting to be written, new scans are refused so the sensors can back off.
+    """
+
+    def __init__(self, out_dir=".", batch_size=100000, flush_interval=10.0,
+                 max_pending=1000000, fmt=None):
+        if fmt is None:
+            fmt = "parquet" if pyarrow is not None else "json"
+        if fmt not in EXTENSIONS:
+            raise ValueError("Unknown format {!r}, use one of {}".format(fmt, sorted(EXTENSIONS)))
+        if fmt == "parquet" and pyarrow is None:
+            raise ValueError("Writing parquet requires pyarrow: pip install pyarrow")
+        self.out_dir = out_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.format = fmt
+        self.batch = ScanBatch()
+        self.pending = 0
+        self.dropped = 0
+        self.files = []
+        self.lock = threading.Lock()
+        self._seq = 0
+        self._retry_at = 0
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add_scans(self, scans):
+        """Buffer (sensor, access_points, timestamp) scans, all or none.
+
+        Returns False when the collector is saturated and nothing was added.
+        Raises ValueError, TypeError or AttributeError when any scan is
+        malformed, again without adding anything.
+        """
+        now = time.time()
+        rows = []
+        for sensor, access_points, timestamp in scans:
+            rows.extend(ScanBatch.rows(sensor, access_points, now if timestamp is None else timestamp))
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.dropped += len(scans)
+                return False
+            self.batch.add(rows, len(scans))
+            self.pending += len(rows)
+            full = len(self.batch) >= self.batch_size
+        if full and time.time() >= self._retry_at:
+            if self._thread is not None:
+                self._wake.set()
+            else:
+                self.flush_or_log()
+        return True
+
+    def add(self, sensor, access_points, timestamp=None):
+        return self.add_scans([(sensor, access_points, timestamp)])
+
+    def flush(self):
+        """Write the current batch to a new file and return its path.
+
+        When writing fails the batch is put back, so it is retried on the next
+        flush and keeps counting towards ``max_pending``.
+        """
+        with self.lock:
+            if not len(self.batch):
+                return None
+            batch, self.batch = self.batch, ScanBatch()
+            self._seq += 1
+            seq = self._seq
+        name = "scans-{}-{:06d}.{}".format(int(time.time()), seq, EXTENSIONS[self.format])
+        path = os.path.join(self.out_dir, name)
+        try:
+            write_batch(batch, path, self.format)
+        except Exception:
+            with self.lock:
+                # keep the failed rows ahead of the ones added in the meantime
+                batch.merge(self.batch)
+                self.batch = batch
+            raise
+        with self.lock:
+            self.pending -= len(batch)
+        self.files.append(path)
+        return path
+
+    def flush_or_log(self):
+        try:
+            path = self.flush()
+        except Exception:
+            self._retry_at = time.time() + self.flush_interval
+            logger.exception("Writing %s scans failed, retrying in %ss",
+                             self.batch.scans, self.flush_interval)
+            return None
+        self._retry_at = 0
+        return path
+
+    def _flush_periodically(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._stop.is_set():
+                self.flush_or_log()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flush_periodically)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.flush()
+
+
+class CollectHTTPHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a sensor does not pay for a new connection per scan
+    protocol_version = "HTTP/1.1"
+
+    def send_error_and_close(self, code, message):
+        # the unread body would be parsed as the next request otherwise
+        self.close_connection = True
+        self.send_error(code, message)
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding"):
+            self.send_error_and_close(411, "Send the body with a Content-Length")
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.send_error_and_close(411, "Send the body with a Content-Length")
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error_and_close(400, "Invalid Content-Length")
+            return
+        if length > MAX_BODY:
+            self.send_error_and_close(413, "Send at most {} bytes per request".format(MAX_BODY))
+            return
+        body = self.rfile.read(length)
+        query = parse_qs(urlparse(self.path).query)
+        sensor = query.get("sensor", [self.client_address[0]])[0]
+        try:
+            accepted = self.server.collector.add_scans(parse_payload(body, sensor))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_error(400, "Expected access_points JSON")
+            return
+        if not accepted:
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # a log line per scan would cost more than ingesting it
+        pass
+
+
+class CollectUDPHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        data = self.request[0]
+        try:
+            self.server.collector.add_scans(parse_payload(data, self.client_address[0]))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+
+class CollectHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, collector):
+        HTTPServer.__init__(self, address, CollectHTTPHandler)
+        self.collector = collector
+
+
+class CollectUDPServer(socketserver.UDPServer):
+    # the default of 8192 bytes truncates larger scans
+    max_packet_size = 65507
+
+    def __init__(self, address, collector):
+        socketserver.UDPServer.__init__(self, address, CollectUDPHandler)
+        self.collector = collector
+
+
+def serve(collector, host="0.0.0.0", http_port=None, udp_port=None):
+    """Start the HTTP and/or UDP endpoints in background threads."""
+    servers = []
+    if http_port is not None:
+        servers.append(CollectHTTPServer((host, http_port), collector))
+    if udp_port is not None:
+        servers.append(CollectUDPServer((host, udp_port), collector))
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return servers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="access_points collect",
+        description="Collect scans from many sensors into columnar files.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--http", type=int, default=8000, help="HTTP port (default: 8000)")
+    parser.add_argument("--udp", type=int, default=None, help="UDP port (default: off)")
+    parser.add_argument("--out", default=".", help="directory to write files to")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default=None,
+                        help="parquet when pyarrow is installed, else json")
+    parser.add_argument("--batch-size", type=int, default=100000)
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds between flushes")
+    parser.add_argument("--max-pending", type=int, default=1000000)
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    collector = Collector(args.out, args.batch_size, args.interval, args.max_pending, args.format)
+    collector.start()
+    servers = serve(collector, args.host, args.http, args.udp)
+    print("Collecting into {} as {}".format(os.path.abspath(args.out), collector.format))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        collector.close()
+        print("Wrote {} files, dropped {} scans".format(len(collector.files), collector.dropped))
+
+
+if __name__ == '__main__':
+    main()
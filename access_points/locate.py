@@ -0,0 +1,172 @@
+""" Estimate positions from the signal strength of access points at known places.
+
+Signal strength is turned into a distance with a log-distance path-loss
+model, and positions are solved by weighted least squares for a whole batch
+of scans at once:
+
+    locator = Locator({"aa:bb:cc:dd:ee:01": (0, 0), "aa:bb:cc:dd:ee:02": (10, 0), ...})
+    locator.locate([wifi_scanner.get_access_points()])
+    # array([[3.1, 4.2]])
+
+Requires numpy.
+"""
+
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# condition number above which the access points seen by a scan are taken
+# to be collinear (or coplanar in 3D), leaving the position undetermined
+MAX_CONDITION = 1e8
+
+
+def quality_to_rssi(quality):
+    """Inverse of ``rssi_to_quality``.
+
+    Holds for the OSX and Termux scanners, and approximately for the
+    percentages of the Windows and NetworkManager scanners.
+    """
+    return quality / 2.0 - 100
+
+
+def iwlist_quality_to_rssi(quality):
+    """RSSI from the ``Quality=NN/70`` numerator reported by iwlist.
+
+    Most Linux drivers derive it as ``signal + 110``, clamped to 0..70.
+    """
+    return quality - 110.0
+
+
+class PathLossModel(object):
+    """Log-distance path loss: ``rssi = tx_power - 10 * exponent * log10(d / d0)``.
+
+    ``tx_power`` is the RSSI measured at ``reference_distance``. The exponent
+    is about 2 in free space and 2.7 to 4 indoors.
+    """
+
+    def __init__(self, tx_power=-40.0, exponent=3.0, reference_distance=1.0):
+        self.tx_power = tx_power
+        self.exponent = exponent
+        self.reference_distance = reference_distance
+
+    def distance(self, rssi):
+        rssi = np.asarray(rssi, dtype=float)
+        return self.reference_distance * 10 ** ((self.tx_power - rssi) / (10.0 * self.exponent))
+
+    def rssi(self, distance):
+        distance = np.asarray(distance, dtype=float)
+        return self.tx_power - 10.0 * self.exponent * np.log10(distance / self.reference_distance)
+
+
+def trilaterate(distances, positions, weights=None):
+    """Solve positions for a batch of scans by weighted least squares.
+
+    ``distances`` has shape (scans, access points) with NaN where an access
+    point was not seen, ``positions`` has shape (access points, dimensions).
+    Each circle ``|x - p|^2 = d^2`` is linear in ``(x, |x|^2)``, so all scans
+    share one design matrix and only the weights and right-hand side differ
+    per scan. Weights default to ``1 / d^2``.
+    Scans that see too few access points to fix a position, or only ones on
+    a line (a plane in 3D), get NaN.
+    """
+    distances = np.atleast_2d(np.asarray(distances, dtype=float))
+    positions = np.asarray(positions, dtype=float)
+    n_aps, dims = positions.shape
+    seen = ~np.isnan(distances)
+    if weights is None:
+        with np.errstate(divide="ignore"):
+            weights = 1.0 / np.maximum(distances, 1e-9) ** 2
+    weights = np.where(seen, np.broadcast_to(weights, distances.shape), 0.0)
+    # only the relative weights within a scan matter, keep them near 1
+    weights = weights / np.maximum(weights.max(axis=1, keepdims=True), 1e-300)
+
+    # solve around the centre of the access points in units of their spread,
+    # so large site or projected coordinates keep the system well conditioned
+    center = positions.mean(axis=0)
+    scale = np.abs(positions - center).max() or 1.0
+    positions = (positions - center) / scale
+    distances = np.where(seen, distances, 0.0) / scale
+
+    # rows [-2 p, 1] with unknowns [x, |x|^2]
+    design = np.hstack([-2 * positions, np.ones((n_aps, 1))])
+    target = distances ** 2 - (positions ** 2).sum(axis=1)
+    normal = np.einsum("si,ij,ik->sjk", weights, design, design)
+    rhs = np.einsum("si,ij->sj", weights * target, design)
+
+    result = np.full((len(distances), dims), np.nan)
+    solvable = seen.sum(axis=1) > dims
+    if solvable.any():
+        eigenvalues = np.linalg.eigvalsh(normal[solvable])
+        solvable[solvable] = eigenvalues[:, 0] * MAX_CONDITION > eigenvalues[:, -1]
+    if solvable.any():
+        solution = np.linalg.solve(normal[solvable], rhs[solvable][..., None])[..., 0]
+        result[solvable] = solution[:, :dims] * scale + center
+    return result
+
+
+class Locator(object):
+    """Locate scans relative to access points with known coordinates.
+
+    ``access_points`` maps a BSSID to its coordinates, in 2 or 3 dimensions.
+    ``to_rssi`` converts the ``quality`` of a scan back to RSSI; the default
+    fits every scanner except iwlist, which needs ``iwlist_quality_to_rssi``.
+    """
+
+    def __init__(self, access_points, model=None, to_rssi=quality_to_rssi):
+        if np is None:
+            raise ImportError("Locating requires numpy: pip install numpy")
+        self.bssids = list(access_points)
+        self.index = {bssid.lower(): i for i, bssid in enumerate(self.bssids)}
+        self.positions = np.array([access_points[bssid] for bssid in self.bssids], dtype=float)
+        self.model = model or PathLossModel()
+        self.to_rssi = to_rssi
+
+    def rssi_matrix(self, scans):
+        """RSSI per scan and known access point, NaN where it was not seen."""
+        rssi = np.full((len(scans), len(self.bssids)), np.nan)
+        for row, access_points in enumerate(scans):
+            for ap in access_points:
+                col = self.index.get((ap["bssid"] or "").lower())
+                if col is not None and ap["quality"] is not None:
+                    rssi[row, col] = ap["quality"]
+        return self.to_rssi(rssi)
+
+    def locate_rssi(self, rssi, weights=None):
+        return trilaterate(self.model.distance(rssi), self.positions, weights)
+
+    def locate(self, scans, weights=None):
+        """Positions for a list of scans, as returned by ``get_access_points``."""
+        return self.locate_rssi(self.rssi_matrix(scans), weights)
+
+
+def simulate(locator, n_scans, noise=2.0, seed=0):
+    """Random positions within the access points' bounds and the RSSI seen there."""
+    rng = np.random.RandomState(seed)
+    low, high = locator.positions.min(axis=0), locator.positions.max(axis=0)
+    truth = low + rng.rand(n_scans, locator.positions.shape[1]) * (high - low)
+    distance = np.linalg.norm(truth[:, None, :] - locator.positions[None, :, :], axis=2)
+    rssi = locator.model.rssi(np.maximum(distance, 0.1)) + rng.normal(0, noise, distance.shape)
+    return truth, rssi
+
+
+def benchmark(batch_sizes=(1, 10, 100, 1000, 10000, 100000), n_aps=8, repeat=3):
+    grid = [(x * 10.0, y * 10.0) for x in range(n_aps // 2) for y in range(2)]
+    locator = Locator({"00:00:00:00:00:{:02x}".format(i): p for i, p in enumerate(grid)})
+    print("{:>8} {:>16} {:>10}".format("batch", "positions/sec", "error (m)"))
+    for size in batch_sizes:
+        truth, rssi = simulate(locator, size)
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.time()
+            found = locator.locate_rssi(rssi)
+            best = min(best, time.time() - start)
+        error = np.median(np.linalg.norm(found - truth, axis=1))
+        print("{:>8} {:>16.0f} {:>10.2f}".format(size, size / max(best, 1e-9), error))
+
+
+if __name__ == '__main__':
+    benchmark()
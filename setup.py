@@ -14,6 +14,7 @@ setup(
     author='Pascal van Kooten',
     author_email='kootenpv@gmail.com',
     entry_points={'console_scripts': ['access_points = access_points.__init__:main']},
+    extras_require={'collect': ['pyarrow'], 'locate': ['numpy']},
     license='MIT',
     packages=find_packages(),
     package_data={'data': ['*.txt']},
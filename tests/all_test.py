@@ -1,4 +1,8 @@
 import os
+import json
+import socket
+import time
+import pytest
 from access_points import OSXWifiScanner, TermuxWifiScanner
 from access_points import WindowsWifiScanner
 from access_points import IwlistWifiScanner
@@ -6,6 +10,7 @@ from access_points import NetworkManagerWifiScanner
 from access_points import get_scanner
 from access_points import AccessPoint
 from access_points import rssi_to_quality
+from access_points.collect import COLUMNS, Collector, parse_payload, read_batch, serve
 
 try:
     basestring
@@ -298,3 +303,222 @@ def test_termux():
          '')
     ]
     assert_all_included(aps, termux_ans)
+
+
+def test_collect_payload():
+    aps = TermuxWifiScanner().parse_output(read_output("termux_test.txt"))
+    assert parse_payload(json.dumps(aps), "hall") == [("hall", aps, None)]
+
+    lines = [json.dumps({"sensor": "s{}".format(i), "time": i, "access_points": aps})
+             for i in range(3)]
+    scans = parse_payload("\n".join(lines).encode("utf8"), "ignored")
+    assert [(s, t) for s, _, t in scans] == [("s0", 0), ("s1", 1), ("s2", 2)]
+
+
+def test_collect_flush(tmpdir):
+    aps = IwlistWifiScanner().parse_output(read_output("iwlist_test.txt"))
+    collector = Collector(str(tmpdir), batch_size=18, fmt="json")
+    collector.add("sensor-a", aps, 1.0)
+    assert collector.files == []
+    collector.add("sensor-b", aps, 2.0)
+    # the second scan filled the batch, the third stays buffered
+    collector.add("sensor-a", aps, 3.0)
+    assert len(collector.files) == 1
+    assert collector.pending == len(aps)
+    assert len(collector.close()) and len(collector.files) == 2
+
+    columns = read_batch(collector.files[0])
+    assert columns["sensor"] == ["sensor-a"] * 9 + ["sensor-b"] * 9
+    assert columns["ssid"][:9] == [ap["ssid"] for ap in aps]
+    assert columns["quality"][9:] == [ap["quality"] for ap in aps]
+    assert columns["security"][0] == "IEEE 802.11i/WPA2 Version 1; WPA Version 1"
+    assert collector.pending == 0
+
+
+def test_collect_backpressure(tmpdir):
+    aps = TermuxWifiScanner().parse_output(read_output("termux_test.txt"))
+    collector = Collector(str(tmpdir), max_pending=3, fmt="json")
+    assert collector.add("sensor", aps)
+    assert collector.add("sensor", aps)
+    assert not collector.add("sensor", aps)
+    assert collector.dropped == 1
+    collector.close()
+    assert collector.add("sensor", aps)
+
+
+def test_locate():
+    np = pytest.importorskip("numpy")
+    from access_points.locate import Locator, PathLossModel
+
+    model = PathLossModel(tx_power=-40, exponent=2)
+    anchors = {"aa:00": (0, 0), "aa:01": (10, 0), "aa:02": (0, 10), "aa:03": (10, 10)}
+    locator = Locator(anchors, model)
+    truth = np.array([[3.0, 4.0], [7.5, 2.0]])
+    scans = []
+    for point in truth:
+        rssi = model.rssi([np.hypot(*(point - p)) for p in anchors.values()])
+        scans.append([AccessPoint("", bssid.upper(), rssi_to_quality(r), "")
+                      for bssid, r in zip(anchors, rssi)])
+    # one access point too few to fix a position
+    scans.append(scans[0][:2])
+    found = locator.locate(scans)
+    assert np.allclose(found[:2], truth, atol=0.1)
+    assert np.isnan(found[2]).all()
+
+
+def test_collect_rejects_whole_payload(tmpdir):
+    aps = TermuxWifiScanner().parse_output(read_output("termux_test.txt"))
+    collector = Collector(str(tmpdir), fmt="json")
+    collector.add("sensor", aps, 1.0)
+    bad_aps = [
+        aps + [{"ssid": "x", "quality": "bad"}],
+        aps + [{"ssid": ["x"], "quality": 10}],
+        aps + [{"ssid": "x", "quality": 2 ** 40}],
+    ]
+    for bad in bad_aps:
+        lines = [json.dumps({"sensor": "good", "access_points": aps}),
+                 json.dumps({"sensor": "bad", "access_points": bad})]
+        with pytest.raises((ValueError, TypeError)):
+            collector.add_scans(parse_payload("\n".join(lines)))
+    assert collector.pending == len(collector.batch) == len(aps)
+    assert len(set(len(getattr(collector.batch, name)) for name in COLUMNS)) == 1
+    assert read_batch(collector.close())["sensor"] == ["sensor"] * len(aps)
+
+
+def test_collect_failed_write_is_retried(tmpdir):
+    aps = TermuxWifiScanner().parse_output(read_output("termux_test.txt"))
+    out_dir = tmpdir.join("missing")
+    collector = Collector(str(out_dir), fmt="json")
+    collector.add("sensor-a", aps, 1.0)
+    with pytest.raises(IOError):
+        collector.flush()
+    assert collector.flush_or_log() is None
+    collector.add("sensor-b", aps, 2.0)
+    assert collector.pending == 2 * len(aps)
+
+    out_dir.mkdir()
+    columns = read_batch(collector.flush())
+    assert columns["sensor"] == ["sensor-a"] * len(aps) + ["sensor-b"] * len(aps)
+    assert columns["time"] == [1.0] * len(aps) + [2.0] * len(aps)
+    assert collector.pending == 0 and len(out_dir.listdir()) == 1
+
+
+def test_locate_geometry():
+    np = pytest.importorskip("numpy")
+    from access_points.locate import Locator, simulate
+
+    square = [(0, 0), (10, 0), (0, 10), (10, 10)]
+    for offset in (0, 1e3, 1e5):
+        locator = Locator({str(i): (x + offset, y - offset) for i, (x, y) in enumerate(square)})
+        truth, rssi = simulate(locator, 100, noise=0)
+        assert np.allclose(locator.locate_rssi(rssi), truth, atol=1e-6)
+
+    # access points on a line cannot tell the two sides of it apart
+    line = Locator({"a": (0, 0), "b": (10, 0), "c": (20, 0)})
+    truth, rssi = simulate(Locator({"a": (0, 0), "b": (10, 0), "c": (20, 0), "d": (0, 10)}), 10)
+    assert np.isnan(line.locate_rssi(rssi[:, :3])).all()
+
+
+def test_locate_iwlist():
+    pytest.importorskip("numpy")
+    from access_points.locate import Locator, iwlist_quality_to_rssi
+
+    aps = IwlistWifiScanner().parse_output(read_output("iwlist_test.txt"))
+    aps = [AccessPoint(ap.ssid, "00:00:00:00:00:0{}".format(i), ap.quality, ap.security)
+           for i, ap in enumerate(aps)]
+    locator = Locator({ap.bssid: (i, 0) for i, ap in enumerate(aps)}, to_rssi=iwlist_quality_to_rssi)
+    # Thomson19D0C8 at Quality=57/70 is seen at -53 dBm
+    assert locator.rssi_matrix([aps])[0, 0] == -53
+
+
+def test_collect_http_body(tmpdir):
+    collector = Collector(str(tmpdir), fmt="json")
+    server = serve(collector, "127.0.0.1", http_port=0)[0]
+    body = b'[{"ssid": "a", "bssid": "b", "quality": 5, "security": ""}]'
+    requests = [
+        (b"Transfer-Encoding: chunked\r\n\r\n" + b"%x\r\n" % len(body) + body + b"\r\n0\r\n\r\n", b"411"),
+        (b"Content-Length: abc\r\n\r\n", b"400"),
+        (b"Content-Length: -1\r\n\r\n", b"400"),
+        (b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body, b"204"),
+    ]
+    try:
+        for headers, status in requests:
+            sock = socket.create_connection(server.server_address, timeout=5)
+            sock.sendall(b"POST /?sensor=s HTTP/1.1\r\nHost: collector\r\n" + headers)
+            response = b""
+            chunk = sock.recv(4096)
+            while chunk:
+                response += chunk
+                chunk = sock.recv(4096)
+            sock.close()
+            # exactly one response, the connection is closed after errors
+            assert response.split(b" ")[1] == status
+            assert response.count(b"HTTP/1.") == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert collector.pending == 1
+
+
+def test_collect_parquet(tmpdir):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    aps = TermuxWifiScanner().parse_output(read_output("termux_test.txt"))
+    aps.append({"ssid": "NoQuality", "bssid": "aa:bb", "quality": None, "security": ""})
+    collector = Collector(str(tmpdir), fmt="parquet")
+    collector.add("sensor-a", aps, 1.0)
+    collector.add("sensor-b", aps, 2.0)
+    path = collector.close()
+
+    table = pyarrow.parquet.read_table(path)
+    dictionaries = {name: table.column(name).chunk(0).dictionary.to_pylist()
+                    for name in ("sensor", "ssid", "bssid", "security")}
+    assert dictionaries == {
+        "sensor": ["sensor-a", "sensor-b"],
+        "ssid": ["ABC", "ABC-5G", "NoQuality"],
+        "bssid": ["c8:52:61:a6:5e:62", "c8:52:61:a6:5e:63", "aa:bb"],
+        "security": [""],
+    }
+    columns = read_batch(path)
+    assert columns["quality"] == [rssi_to_quality(-37), rssi_to_quality(-44), None] * 2
+    assert columns["time"] == [1.0] * 3 + [2.0] * 3
+
+
+def test_collect_missing_quality(tmpdir):
+    collector = Collector(str(tmpdir), fmt="json")
+    collector.add("sensor", [{"ssid": "a", "bssid": "b", "quality": None, "security": ""},
+                             {"ssid": "a", "bssid": "c", "quality": -1, "security": ""}])
+    assert read_batch(collector.close())["quality"] == [None, -1]
+
+
+def test_collect_failed_write_backs_off(tmpdir):
+    aps = TermuxWifiScanner().parse_output(read_output("termux_test.txt"))
+    collector = Collector(str(tmpdir.join("missing")), batch_size=1, flush_interval=60, fmt="json")
+    attempts = []
+    flush = collector.flush
+
+    def counting_flush():
+        attempts.append(1)
+        return flush()
+    collector.flush = counting_flush
+    for _ in range(5):
+        assert collector.add("sensor", aps)
+    # only the first full batch tries to write, the rest wait for the retry
+    assert len(attempts) == 1
+    assert collector.pending == 5 * len(aps)
+
+
+def test_collect_flushes_on_thread(tmpdir):
+    aps = TermuxWifiScanner().parse_output(read_output("termux_test.txt"))
+    collector = Collector(str(tmpdir), batch_size=1, flush_interval=60, fmt="json")
+    collector.start()
+    try:
+        collector.add("sensor", aps)
+        for _ in range(100):
+            if collector.files:
+                break
+            time.sleep(0.05)
+        assert len(collector.files) == 1
+    finally:
+        collector.close()